@@ -1,31 +1,53 @@
 # DB connection boilerplate
 
 import io
+import itertools
+import operator
+import queue
+import struct
+import threading
+from contextlib import contextmanager
 import psycopg2
 import psycopg2.extras
 
+try:
+    import psycopg
+except ImportError:  # psycopg 3 is optional, its benchmarks are skipped
+    psycopg = None
+
 # parsers
 import datetime
+import decimal
+from functools import lru_cache
 
 # metrics
+import resource
+import sys
 import time
 from functools import wraps
-from memory_profiler import memory_usage
 
 # data fetchers
-from typing import Iterator, Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Dict, Any, List, Optional, Sequence, Tuple, Union
 from urllib.parse import urlencode
 import requests
 
+try:
+    import ijson
+except ImportError:  # ijson is optional, pages are then parsed with response.json()
+    ijson = None
+
 
-connection = psycopg2.connect(
+DB_PARAMS = dict(
     host="127.0.0.1",
-    database="slowflow",
+    dbname="slowflow",
     user="slowflow",
     password="powers",
     port=5433
 )
-connection.autocommit = True
+
+connection = psycopg2.connect(**DB_PARAMS)
+connection.autocommit = False
 
 CREATE_TABLE = """
 DROP TABLE IF EXISTS staging_beers;
@@ -37,31 +59,45 @@ CREATE UNLOGGED TABLE staging_beers (
     first_brewed        DATE,
     description         TEXT,
     image_url           TEXT,
-    abv                 DECIMAL,
-    ibu                 DECIMAL,
-    target_fg           DECIMAL,
-    target_ob           DECIMAL,
-    ebc                 DECIMAL,
-    srm                 DECIMAL,
-    ph                  DECIMAL,
-    attenuation_level   DECIMAL,
+    abv                 {measure_type},
+    ibu                 {measure_type},
+    target_fg           {measure_type},
+    target_og           {measure_type},
+    ebc                 {measure_type},
+    srm                 {measure_type},
+    ph                  {measure_type},
+    attenuation_level   {measure_type},
     brewers_tips        TEXT,
     contributed_by      TEXT,
     volume              INTEGER
-);
+) WITH (autovacuum_enabled = off);
 """
 
+VALUES_TEMPLATE = '(' + ','.join(['%s'] * 17) + ')'
+INSERT_SQL = 'INSERT INTO staging_beers VALUES ' + VALUES_TEMPLATE
+INSERT_VALUES_SQL = 'INSERT INTO staging_beers VALUES %s'
+
 # DB Creation fx
-def create_staging_table(cursor) -> None:
-    cursor.execute(CREATE_TABLE)
+def create_staging_table(cursor, measure_type: str = 'REAL') -> None:
+    cursor.execute(CREATE_TABLE.format(measure_type=measure_type))
+
+
+@contextmanager
+def load_transaction(connection) -> Iterator[Any]:
+    """Yield a cursor in a single transaction with synchronous_commit off"""
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL synchronous_commit = OFF')
+            yield cursor
 
 
 # parsers
 
+@lru_cache(maxsize=4096)
 def parse_first_brewed(text: str) -> datetime.date:
     """Return a datetime object of text, a string
     >>> parse_first_brewed('09/2007')
-    datetime.time(2007, 9, 1)
+    datetime.date(2007, 9, 1)
     >>> parse_first_brewed('2006')
     datetime.date(2006, 1, 1)
     """
@@ -73,29 +109,79 @@ def parse_first_brewed(text: str) -> datetime.date:
     else:
         assert False, 'Unknown date format'
 
+
+@lru_cache(maxsize=4096)
+def parse_first_brewed_iso(text: str) -> str:
+    """Return the ISO 8601 form of text, as used by the COPY text paths
+    >>> parse_first_brewed_iso('09/2007')
+    '2007-09-01'
+    """
+    return parse_first_brewed(text).isoformat()
+
 # data fetchers
 
-def iter_beers_from_api(page_size: int = 5) -> Iterator[Dict[str, Any]]:
-    session = requests.Session()
+def fetch_beer_page(
+    session: requests.Session,
+    url: str,
+    page: int,
+    page_size: int,
+) -> requests.Response:
+    """Request a page and return as soon as the headers arrive"""
+    response = session.get(url + urlencode({
+        'page': page,
+        'per_page': page_size
+    }), stream=True)
+    response.raise_for_status()
+    return response
+
+
+def iter_beer_page(response: requests.Response) -> Iterator[Dict[str, Any]]:
+    """Yield beers while the page body is still being received"""
+    if ijson is None:
+        yield from response.json()
+        return
+
+    response.raw.decode_content = True
+    yield from ijson.items(response.raw, 'item', use_float=True)
+
+
+def iter_beers_from_api(
+    page_size: int = 80,
+    max_workers: int = 8,
+) -> Iterator[Dict[str, Any]]:
+    """Yield beers in page order, fetching max_workers pages concurrently"""
     page = 1
     url = 'https://api.punkapi.com/v2/beers?'
 
-    while True:
-        response = session.get(url + urlencode({
-            'page': page,
-            'per_page': page_size
-        }))
-        response.raise_for_status()
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        session.headers.update({'Accept-Encoding': 'gzip'})
+        while True:
+            futures = [
+                executor.submit(fetch_beer_page, session, url, n, page_size)
+                for n in range(page, page + max_workers)
+            ]
+            try:
+                for future in futures:
+                    with future.result() as response:
+                        empty = True
+                        for beer in iter_beer_page(response):
+                            empty = False
+                            yield beer
+                    if empty:
+                        return
+            finally:
+                # release the connections of pages fetched past the last one read
+                for future in futures:
+                    if not future.cancel() and future.exception() is None:
+                        future.result().close()
+
+            page += max_workers
 
-        data = response.json()
-        if not data:
-            break
-        
-        yield from data
+# metrics
 
-        page += 1
+# ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
 
-# metrics
 
 def profile(fn):
     @wraps(fn)
@@ -103,148 +189,82 @@ def profile(fn):
         fn_kwargs_str = ', '.join(f'{k}={v}' for k, v in kwargs.items())
         print(f'\n{fn.__name__}({fn_kwargs_str})')
 
-        # measure time
-        t = time.perf_counter()
-        retval = fn(*args, **kwargs)
-        elapsed = time.perf_counter() - t
+        # measure time and peak RSS growth in a single, untraced run;
+        # ru_maxrss is a high-water mark, so only growth past earlier peaks shows
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t = time.perf_counter_ns()
+        try:
+            retval = fn(*args, **kwargs)
+        finally:
+            elapsed = (time.perf_counter_ns() - t) / 1e9
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
         print(f'Time {elapsed:0.4}')
-
-        # measure memory
-        mem, retval = memory_usage(
-            (fn, args, kwargs), retval=True, timeout=200, interval=1e-7)
-        print(f'Memory {max(mem) - min(mem)}')
+        print(f'Memory {(rss_after - rss_before) * MAXRSS_UNIT / 1e6:0.4} MB')
         return retval
     
     return inner
 
 # Stuff to profile
 
+## Build the positional row shared by every INSERT variant
+get_beer_fields = operator.itemgetter(
+    'id',
+    'name',
+    'tagline',
+    'first_brewed',
+    'description',
+    'image_url',
+    'abv',
+    'ibu',
+    'target_fg',
+    'target_og',
+    'ebc',
+    'srm',
+    'ph',
+    'attenuation_level',
+    'brewers_tips',
+    'contributed_by',
+)
+
+def beer_values(beer: Dict[str, Any]) -> Tuple[Any, ...]:
+    values = get_beer_fields(beer)
+    return (
+        *values[:3],
+        parse_first_brewed(values[3]),
+        *values[4:],
+        beer['volume']['value'],
+    )
+
 ## Insert rows one-by-one
 @profile
 def insert_one_by_one(connection, beers: Iterator[Dict[str, Any]]) -> None:
-    with connection.cursor() as cursor:
+    with load_transaction(connection) as cursor:
         create_staging_table(cursor)
         for beer in beers:
-            cursor.execute("""
-                INSERT INTO staging_beers VALUES (
-                    %(id)s,
-                    %(name)s,
-                    %(tagline)s,
-                    %(first_brewed)s,
-                    %(description)s,
-                    %(image_url)s,
-                    %(abv)s,
-                    %(ibu)s,
-                    %(target_fg)s,
-                    %(target_og)s,
-                    %(ebc)s,
-                    %(srm)s,
-                    %(ph)s,
-                    %(attenuation_level)s,
-                    %(brewers_tips)s,
-                    %(contributed_by)s,
-                    %(volume)s
-                );
-            """, {
-                **beer,
-                'first_brewed': parse_first_brewed(beer['first_brewed']),
-                'volume': beer['volume']['value'],
-            })
+            cursor.execute(INSERT_SQL, beer_values(beer))
 
 @profile
 def insert_executemany(connection, beers: Iterator[Dict[str, Any]]) -> None:
-    with connection.cursor() as cursor:
+    with load_transaction(connection) as cursor:
         create_staging_table(cursor)
-        all_beers = [{
-            **beer,
-            'first_brewed': parse_first_brewed(beer['first_brewed']),
-            'volume': beer['volume']['value'],
-        } for beer in beers]
-
-        cursor.executemany("""
-            INSERT INTO staging_beers VALUES (
-                %(id)s,
-                %(name)s,
-                %(tagline)s,
-                %(first_brewed)s,
-                %(description)s,
-                %(image_url)s,
-                %(abv)s,
-                %(ibu)s,
-                %(target_fg)s,
-                %(target_og)s,
-                %(ebc)s,
-                %(srm)s,
-                %(ph)s,
-                %(attenuation_level)s,
-                %(brewers_tips)s,
-                %(contributed_by)s,
-                %(volume)s
-            );
-        """, all_beers)
+        all_beers = [beer_values(beer) for beer in beers]
+
+        cursor.executemany(INSERT_SQL, all_beers)
 
 @profile
 def insert_executemany_iterator(connection, beers: Iterator[Dict[str, Any]]) -> None:
-    with connection.cursor() as cursor:
+    with load_transaction(connection) as cursor:
         create_staging_table(cursor)
-        cursor.executemany("""
-            INSERT INTO staging_beers VALUES (
-                %(id)s,
-                %(name)s,
-                %(tagline)s,
-                %(first_brewed)s,
-                %(description)s,
-                %(image_url)s,
-                %(abv)s,
-                %(ibu)s,
-                %(target_fg)s,
-                %(target_og)s,
-                %(ebc)s,
-                %(srm)s,
-                %(ph)s,
-                %(attenuation_level)s,
-                %(brewers_tips)s,
-                %(contributed_by)s,
-                %(volume)s
-            );
-        """, ({
-            **beer,
-            'first_brewed': parse_first_brewed(beer['first_brewed']),
-            'volume': beer['volume']['value']
-        } for beer in beers))
+        cursor.executemany(INSERT_SQL, (beer_values(beer) for beer in beers))
 
 @profile
 def insert_execute_batch(connection, beers: Iterator[Dict[str, Any]]) -> None:
-    with connection.cursor() as cursor:
+    with load_transaction(connection) as cursor:
         create_staging_table(cursor)
 
-        all_beers = [{
-            **beer,
-            'first_brewed': parse_first_brewed(beer['first_brewed']),
-            'volume': beer['volume']['value'],
-        } for beer in beers]
-
-        psycopg2.extras.execute_batch(cursor, """
-            INSERT INTO staging_beers VALUES (
-                %(id)s,
-                %(name)s,
-                %(tagline)s,
-                %(first_brewed)s,
-                %(description)s,
-                %(image_url)s,
-                %(abv)s,
-                %(ibu)s,
-                %(target_fg)s,
-                %(target_og)s,
-                %(ebc)s,
-                %(srm)s,
-                %(ph)s,
-                %(attenuation_level)s,
-                %(brewers_tips)s,
-                %(contributed_by)s,
-                %(volume)s
-            );
-        """, all_beers)
+        all_beers = [beer_values(beer) for beer in beers]
+
+        psycopg2.extras.execute_batch(cursor, INSERT_SQL, all_beers)
 
 @profile
 def insert_execute_batch_iterator(
@@ -252,120 +272,61 @@ def insert_execute_batch_iterator(
     beers: Iterator[Dict[str, Any]],
     page_size: int = 100
 ) -> None:
-    with connection.cursor() as cursor:
+    with load_transaction(connection) as cursor:
         create_staging_table(cursor)
 
-        iter_beers = ({
-            **beer,
-            'first_brewed': parse_first_brewed(beer['first_brewed']),
-            'volume': beer['volume']['value'],
-        } for beer in beers)
-
-        psycopg2.extras.execute_batch(cursor, """
-            INSERT INTO staging_beers VALUES (
-                %(id)s,
-                %(name)s,
-                %(tagline)s,
-                %(first_brewed)s,
-                %(description)s,
-                %(image_url)s,
-                %(abv)s,
-                %(ibu)s,
-                %(target_fg)s,
-                %(target_og)s,
-                %(ebc)s,
-                %(srm)s,
-                %(ph)s,
-                %(attenuation_level)s,
-                %(brewers_tips)s,
-                %(contributed_by)s,
-                %(volume)s
-            );
-        """, iter_beers, page_size=page_size)
+        iter_beers = (beer_values(beer) for beer in beers)
+
+        psycopg2.extras.execute_batch(cursor, INSERT_SQL, iter_beers, page_size=page_size)
 
 
 @profile
 def insert_execute_values(connection, beers: Iterator[Dict[str, Any]]) -> None:
-    with connection.cursor() as cursor:
+    with load_transaction(connection) as cursor:
         create_staging_table(cursor)
-        psycopg2.extras.execute_values(cursor, """
-            INSERT INTO staging_beers VALUES %s;
-        """, [(
-            beer['id'],
-            beer['name'],
-            beer['tagline'],
-            parse_first_brewed(beer['first_brewed']),
-            beer['description'],
-            beer['image_url'],
-            beer['abv'],
-            beer['ibu'],
-            beer['target_fg'],
-            beer['target_og'],
-            beer['ebc'],
-            beer['srm'],
-            beer['ph'],
-            beer['attenuation_level'],
-            beer['brewers_tips'],
-            beer['contributed_by'],
-            beer['volume']['value'],
-        ) for beer in beers])            
+        psycopg2.extras.execute_values(
+            cursor,
+            INSERT_VALUES_SQL,
+            [beer_values(beer) for beer in beers],
+            template=VALUES_TEMPLATE,
+            page_size=1000,
+        )
 
 
 @profile
-def insert_execute_values_iterator(connection, beers: Iterator[Dict[str, Any]]) -> None:
-    with connection.cursor() as cursor:
+def insert_execute_values_iterator(
+    connection,
+    beers: Iterator[Dict[str, Any]],
+    page_size: int = 1000,
+) -> None:
+    with load_transaction(connection) as cursor:
         create_staging_table(cursor)
-        psycopg2.extras.execute_values(cursor, """
-            INSERT INTO staging_beers VALUES %s;
-        """, ((
-            beer['id'],
-            beer['name'],
-            beer['tagline'],
-            parse_first_brewed(beer['first_brewed']),
-            beer['description'],
-            beer['image_url'],
-            beer['abv'],
-            beer['ibu'],
-            beer['target_fg'],
-            beer['target_og'],
-            beer['ebc'],
-            beer['srm'],
-            beer['ph'],
-            beer['attenuation_level'],
-            beer['brewers_tips'],
-            beer['contributed_by'],
-            beer['volume']['value'],
-        ) for beer in beers))
+        psycopg2.extras.execute_values(
+            cursor,
+            INSERT_VALUES_SQL,
+            (beer_values(beer) for beer in beers),
+            template=VALUES_TEMPLATE,
+            page_size=page_size,
+        )
+
 
 @profile
-def insert_execute_values_iterator(
+def insert_mogrify_bulk(
     connection,
     beers: Iterator[Dict[str, Any]],
-    page_size: int = 100,
+    page_size: int = 5000,
 ) -> None:
-    with connection.cursor() as cursor:
+    """Send each page of beers as one mogrify-built multi-row INSERT"""
+    with load_transaction(connection) as cursor:
         create_staging_table(cursor)
-        psycopg2.extras.execute_values(cursor, """
-            INSERT INTO staging_beers VALUES %s;
-        """, ((
-            beer['id'],
-            beer['name'],
-            beer['tagline'],
-            parse_first_brewed(beer['first_brewed']),
-            beer['description'],
-            beer['image_url'],
-            beer['abv'],
-            beer['ibu'],
-            beer['target_fg'],
-            beer['target_og'],
-            beer['ebc'],
-            beer['srm'],
-            beer['ph'],
-            beer['attenuation_level'],
-            beer['brewers_tips'],
-            beer['contributed_by'],
-            beer['volume']['value'],
-        ) for beer in beers), page_size=page_size)
+        rows = (beer_values(beer) for beer in beers)
+        while True:
+            page = list(itertools.islice(rows, page_size))
+            if not page:
+                break
+            cursor.execute(b'INSERT INTO staging_beers VALUES ' + b','.join(
+                cursor.mogrify(VALUES_TEMPLATE, row) for row in page
+            ))
 
 
 # Using Copy
@@ -376,7 +337,7 @@ def clean_csv_value(value: Optional[Any]) -> str:
 
 @profile
 def copy_stringio(connection, beers: Iterator[Dict[str, Any]]) -> None:
-    with connection.cursor() as cursor:
+    with load_transaction(connection) as cursor:
         create_staging_table(cursor)
         csv_file_like_object = io.StringIO()
         for beer in beers:
@@ -395,98 +356,378 @@ def copy_stringio(connection, beers: Iterator[Dict[str, Any]]) -> None:
                 beer['srm'],
                 beer['ph'],
                 beer['attenuation_level'],
-                beer['contributed_by'],
                 beer['brewers_tips'],
-                beer['volume']['value'],                
+                beer['contributed_by'],
+                beer['volume']['value'],
             )))+ '\n')
         csv_file_like_object.seek(0)
         cursor.copy_from(csv_file_like_object, 'staging_beers', sep='|')
 
 
-class StringIteratorIO(io.TextIOBase):
-    def __init__(self, iter: Iterator[str]):
+class BytesIteratorIO(io.RawIOBase):
+    def __init__(self, iter: Iterator[bytes]):
         self._iter = iter
-        self._buff = ''
-    
+        self._buff = bytearray()
+
     def readable(self) -> bool:
         return True
-    
-    def _read1(self, n: Optional[int] = None) -> str:
-        while not self._buff:
+
+    def readinto(self, b) -> int:
+        want = len(b)
+        while len(self._buff) < want:
             try:
-                self._buff = next(self._iter)
+                self._buff += next(self._iter)
             except StopIteration:
                 break
-        ret = self._buff[:n]
-        self._buff = self._buff[len(ret):]
-        return ret
-    
-    def read(self, n: Optional[int] = None) -> str:
-        line = []
-        if n is None or n < 0:
-            while True:
-                m = self._read1(n)
-                if not m:
-                    break
-                line.append(m)
-        else:
-            while n > 0:
-                m = self._read1(n)
-                if not m:
-                    break
-                n -= len(m)
-                line.append(m)
-        return ''.join(line)
+        n = min(want, len(self._buff))
+        with memoryview(self._buff) as buff, memoryview(b) as out:
+            out.cast('B')[:n] = buff[:n]
+        # deleting from the front of a bytearray only moves its start pointer
+        del self._buff[:n]
+        return n
+
+
+# Serialize a row for COPY text format with one f-string per beer
+COPY_TEXT_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\n': '\\n',
+    '\r': '\\r',
+    '|': '\\|',
+})
+
+
+def csv_text(value: Optional[str]) -> str:
+    if value is None:
+        return r'\N'
+    return value.translate(COPY_TEXT_ESCAPES)
+
+
+def csv_number(value: Optional[Any]) -> Any:
+    if value is None:
+        return r'\N'
+    return value
+
+
+def csv_row(beer: Dict[str, Any]) -> str:
+    (
+        id_, name, tagline, first_brewed, description, image_url,
+        abv, ibu, target_fg, target_og, ebc, srm, ph, attenuation_level,
+        brewers_tips, contributed_by,
+    ) = get_beer_fields(beer)
+    return (
+        f"{id_}|"
+        f"{csv_text(name)}|"
+        f"{csv_text(tagline)}|"
+        f"{parse_first_brewed_iso(first_brewed)}|"
+        f"{csv_text(description)}|"
+        f"{csv_text(image_url)}|"
+        f"{csv_number(abv)}|"
+        f"{csv_number(ibu)}|"
+        f"{csv_number(target_fg)}|"
+        f"{csv_number(target_og)}|"
+        f"{csv_number(ebc)}|"
+        f"{csv_number(srm)}|"
+        f"{csv_number(ph)}|"
+        f"{csv_number(attenuation_level)}|"
+        f"{csv_text(brewers_tips)}|"
+        f"{csv_text(contributed_by)}|"
+        f"{beer['volume']['value']}\n"
+    )
 
 
 # Now use this iterator with COPY
+COPY_TEXT_SQL = "COPY staging_beers FROM STDIN WITH (FORMAT text, DELIMITER '|', NULL '\\N')"
+
 @profile
 def copy_string_iterator(
     connection,
     beers: Iterator[Dict[str, Any]],
-    size: int = 8192
+    size: int = 65536
 ) -> None:
-    with connection.cursor() as cursor:
+    with load_transaction(connection) as cursor:
         create_staging_table(cursor)
 
-        beer_gen = (
-            '|'.join(map(clean_csv_value, (
-                beer['id'],
-                beer['name'],
-                beer['tagline'],
-                parse_first_brewed(beer['first_brewed']).isoformat(),
-                beer['description'],
-                beer['image_url'],
-                beer['abv'],
-                beer['ibu'],
-                beer['target_fg'],
-                beer['target_og'],
-                beer['ebc'],
-                beer['srm'],
-                beer['ph'],
-                beer['attenuation_level'],
-                beer['brewers_tips'],
-                beer['contributed_by'],
-                beer['volume']['value'],                
-            ))) + '\n'
-            for beer in beers
+        beer_gen = (csv_row(beer).encode('utf-8') for beer in beers)
+        beers_bytes_iterator = BytesIteratorIO(beer_gen)
+        cursor.copy_expert(
+            COPY_TEXT_SQL,
+            beers_bytes_iterator,
+            size=size,
         )
-        beers_string_iterator = StringIteratorIO(beer_gen)
-        cursor.copy_from(beers_string_iterator, 'staging_beers', sep='|', size=size)
+
+
+# Spread COPY over several backends, one connection per worker thread
+def copy_worker(chunks: queue.Queue, size: int, cancelled: threading.Event) -> None:
+    def iter_chunks() -> Iterator[List[Dict[str, Any]]]:
+        while True:
+            try:
+                chunk = chunks.get(timeout=1)
+            except queue.Empty:
+                if cancelled.is_set():
+                    # raising inside COPY aborts it and rolls the transaction back
+                    raise RuntimeError('parallel COPY cancelled')
+                continue
+            if chunk is None:
+                return
+            yield chunk
+
+    worker_connection = psycopg2.connect(**DB_PARAMS)
+    try:
+        with load_transaction(worker_connection) as cursor:
+            beer_gen = (
+                csv_row(beer).encode('utf-8')
+                for chunk in iter_chunks()
+                for beer in chunk
+            )
+            cursor.copy_expert(COPY_TEXT_SQL, BytesIteratorIO(beer_gen), size=size)
+    finally:
+        worker_connection.close()
+
+
+@profile
+def copy_string_parallel(
+    connection,
+    beers: Iterator[Dict[str, Any]],
+    workers: int = 4,
+    chunk_size: int = 1000,
+    size: int = 65536,
+) -> None:
+    with load_transaction(connection) as cursor:
+        create_staging_table(cursor)
+
+    queues = [queue.Queue(maxsize=4) for _ in range(workers)]
+    cancelled = threading.Event()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(copy_worker, q, size, cancelled) for q in queues]
+
+        def put(i: int, item: Optional[List[Dict[str, Any]]]) -> None:
+            while True:
+                try:
+                    queues[i].put(item, timeout=1)
+                    return
+                except queue.Full:
+                    if futures[i].done():
+                        futures[i].result()  # re-raise the worker's error
+
+        # fan chunks out round-robin, then tell every worker to finish
+        try:
+            beers = iter(beers)
+            for i, chunk in enumerate(iter(lambda: list(itertools.islice(beers, chunk_size)), [])):
+                put(i % workers, chunk)
+            for i in range(workers):
+                put(i, None)
+        except BaseException:
+            # unblock the other workers so the executor can shut down
+            cancelled.set()
+            raise
+
+        for future in futures:
+            future.result()
+
+
+# Using COPY with the binary format
+PG_EPOCH = datetime.date(2000, 1, 1)
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\0' + struct.pack('>II', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('>h', -1)
+COPY_BINARY_NULL = struct.pack('>i', -1)
+COPY_BINARY_FIELD_COUNT = struct.pack('>h', 17)
+
+
+def pack_int4(value: Optional[int]) -> bytes:
+    if value is None:
+        return COPY_BINARY_NULL
+    return struct.pack('>ii', 4, value)
+
+
+def pack_float4(value: Optional[float]) -> bytes:
+    if value is None:
+        return COPY_BINARY_NULL
+    return struct.pack('>if', 4, value)
+
+
+def pack_text(value: Optional[str]) -> bytes:
+    if value is None:
+        return COPY_BINARY_NULL
+    data = value.encode('utf-8')
+    return struct.pack('>i', len(data)) + data
+
+
+def pack_date(value: datetime.date) -> bytes:
+    return struct.pack('>ii', 4, (value - PG_EPOCH).days)
+
+
+NUMERIC_POS = 0x0000
+NUMERIC_NEG = 0x4000
+NUMERIC_NAN = 0xC000
+
+
+def pack_numeric(value: Optional[Union[float, int, str]]) -> bytes:
+    """Return value as a NUMERIC field: base-10000 digits plus weight, sign and scale
+
+    Fields unpack as (length, ndigits, weight, sign, dscale, *digits)
+    >>> struct.unpack('>ihhHHHH', pack_numeric(4.5))
+    (12, 2, 0, 0, 1, 4, 5000)
+    >>> struct.unpack('>ihhHHHH', pack_numeric(-3.25))
+    (12, 2, 0, 16384, 2, 3, 2500)
+    >>> struct.unpack('>ihhHHH', pack_numeric(0.05))
+    (10, 1, -1, 0, 2, 500)
+    >>> pack_numeric(float('inf'))
+    Traceback (most recent call last):
+        ...
+    ValueError: NUMERIC cannot represent inf
+    """
+    if value is None:
+        return COPY_BINARY_NULL
+    text = value if isinstance(value, str) else repr(value)
+    if text.lower() == 'nan':
+        return struct.pack('>ihhHH', 8, 0, 0, NUMERIC_NAN, 0)
+    if text.lstrip('+-').lower() in ('inf', 'infinity'):
+        # only PostgreSQL 14+ accepts infinite NUMERIC values
+        raise ValueError(f'NUMERIC cannot represent {text}')
+    if 'e' in text or 'E' in text:
+        text = format(decimal.Decimal(text), 'f')
+
+    sign = NUMERIC_NEG if text.startswith('-') else NUMERIC_POS
+    int_part, _, frac_part = text.lstrip('+-').partition('.')
+    dscale = len(frac_part)
+
+    # left-pad the integer part and right-pad the fraction to whole base-10000 digits
+    int_part = int_part.lstrip('0')
+    int_part = int_part.zfill(-(-len(int_part) // 4) * 4)
+    frac_part = frac_part.ljust(-(-len(frac_part) // 4) * 4, '0')
+    digits_text = int_part + frac_part
+    digits = [int(digits_text[i:i + 4]) for i in range(0, len(digits_text), 4)]
+    weight = len(int_part) // 4 - 1
+
+    while digits and digits[0] == 0:
+        digits.pop(0)
+        weight -= 1
+    while digits and digits[-1] == 0:
+        digits.pop()
+    if not digits:
+        weight, sign = 0, NUMERIC_POS
+
+    ndigits = len(digits)
+    return struct.pack(
+        f'>ihhHH{ndigits}H',
+        8 + 2 * ndigits, ndigits, weight, sign, dscale, *digits,
+    )
+
+
+def pack_beer_binary(
+    beer: Dict[str, Any],
+    pack_measure: Callable[[Any], bytes] = pack_float4,
+) -> bytes:
+    """Return one staging_beers tuple in the COPY BINARY wire format"""
+    (
+        id_, name, tagline, first_brewed, description, image_url,
+        abv, ibu, target_fg, target_og, ebc, srm, ph, attenuation_level,
+        brewers_tips, contributed_by,
+    ) = get_beer_fields(beer)
+    return b''.join((
+        COPY_BINARY_FIELD_COUNT,
+        pack_int4(id_),
+        pack_text(name),
+        pack_text(tagline),
+        pack_date(parse_first_brewed(first_brewed)),
+        pack_text(description),
+        pack_text(image_url),
+        pack_measure(abv),
+        pack_measure(ibu),
+        pack_measure(target_fg),
+        pack_measure(target_og),
+        pack_measure(ebc),
+        pack_measure(srm),
+        pack_measure(ph),
+        pack_measure(attenuation_level),
+        pack_text(brewers_tips),
+        pack_text(contributed_by),
+        pack_int4(beer['volume']['value']),
+    ))
+
+
+@profile
+def copy_binary_iterator(
+    connection,
+    beers: Iterator[Dict[str, Any]],
+    size: int = 8192,
+    numeric: bool = False,
+) -> None:
+    """Load beers with COPY BINARY, as REAL or, with numeric=True, NUMERIC measurements"""
+    measure_type, pack_measure = ('NUMERIC', pack_numeric) if numeric else ('REAL', pack_float4)
+    with load_transaction(connection) as cursor:
+        create_staging_table(cursor, measure_type)
+
+        beer_gen = itertools.chain(
+            (COPY_BINARY_HEADER,),
+            (pack_beer_binary(beer, pack_measure) for beer in beers),
+            (COPY_BINARY_TRAILER,),
+        )
+        beers_bytes_iterator = BytesIteratorIO(beer_gen)
+        cursor.copy_expert(
+            'COPY staging_beers FROM STDIN WITH (FORMAT BINARY)',
+            beers_bytes_iterator,
+            size=size,
+        )
+
+
+# Using psycopg 3, whose executemany pipelines every row behind a single Sync
+@profile
+def insert_executemany_pipeline(connection, beers: Iterator[Dict[str, Any]]) -> None:
+    with connection.transaction(), connection.cursor() as cursor:
+        cursor.execute('SET LOCAL synchronous_commit = OFF')
+        create_staging_table(cursor)
+        with connection.pipeline():
+            cursor.executemany(INSERT_SQL, (beer_values(beer) for beer in beers))
+
+
+@profile
+def copy_write_row(connection, beers: Iterator[Dict[str, Any]]) -> None:
+    with connection.transaction(), connection.cursor() as cursor:
+        cursor.execute('SET LOCAL synchronous_commit = OFF')
+        create_staging_table(cursor)
+        with cursor.copy('COPY staging_beers FROM STDIN') as copy:
+            for beer in beers:
+                copy.write_row(beer_values(beer))
+
+
+REPLICAS = 100
+
+
+def iter_replicated(
+    beers: Sequence[Dict[str, Any]],
+    times: int = REPLICAS,
+) -> Iterator[Dict[str, Any]]:
+    """Lazily repeat beers instead of materialising a list times as long"""
+    return itertools.chain.from_iterable(itertools.repeat(beers, times))
 
 
 def main() -> None:
     print('loading beers')
-    beers = list(iter_beers_from_api()) * 100
-    print(f'\n loaded {len(beers)} beers \n')
+    beers = tuple(iter_beers_from_api())
+    print(f'\n loaded {len(beers) * REPLICAS} beers \n')
     print('now for benchmarks')
 
-    insert_one_by_one(connection, beers)
-    insert_executemany(connection, beers)
-    insert_execute_values_iterator(connection, beers, page_size=100)
-    insert_execute_values_iterator(connection, beers, page_size=1000)
-    copy_string_iterator(connection, beers, size=1024)
-    copy_string_iterator(connection, beers, size=8192)
+    # insert_one_by_one, insert_executemany* and insert_execute_batch* are kept
+    # for reference but left out of the default run. The psycopg2 docs warn
+    # that executemany() is no faster than execute() in a loop, and
+    # execute_batch() still sends one INSERT per row for the server to parse
+    # and plan. execute_values() sends one multi-row VALUES statement per page.
+    insert_execute_values_iterator(connection, iter_replicated(beers), page_size=100)
+    insert_execute_values_iterator(connection, iter_replicated(beers), page_size=1000)
+    insert_execute_values_iterator(connection, iter_replicated(beers), page_size=10_000)
+    insert_mogrify_bulk(connection, iter_replicated(beers), page_size=5000)
+    copy_string_iterator(connection, iter_replicated(beers), size=1024)
+    copy_string_iterator(connection, iter_replicated(beers), size=8192)
+    copy_string_iterator(connection, iter_replicated(beers), size=65536)
+    copy_binary_iterator(connection, iter_replicated(beers), size=65536)
+    copy_binary_iterator(connection, iter_replicated(beers), size=65536, numeric=True)
+    copy_string_parallel(connection, iter_replicated(beers), workers=4)
+
+    if psycopg is not None:
+        with psycopg.connect(**DB_PARAMS) as connection3:
+            insert_executemany_pipeline(connection3, iter_replicated(beers))
+            copy_write_row(connection3, iter_replicated(beers))
 
 
 if __name__ == '__main__':